@@ -47,12 +47,45 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Ben Hubbard / v0.0.1
 """
 
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
+from matplotlib.figure import Figure
+import numpy as np
 import re
 import os
 
 
-def generate_report(log, savepath, reportname="report.md"):
+# __slots__ is written by hand, as dataclass(slots=True) needs Python
+# 3.10. None of the fields has a default, so they don't clash.
+@dataclass
+class VariableSpec:
+    """A variable called out for plotting."""
+
+    __slots__ = ('name', 'tests', 'scale')
+
+    name: str       # Key of the variable in the data dictionary.
+    tests: tuple    # Indices of the tests to plot it from.
+    scale: float    # Scaling factor applied before plotting.
+
+
+@dataclass
+class PlotSpec:
+    """Everything needed to generate one requested plot."""
+
+    __slots__ = ('x', 'ys', 'xlabel', 'ylabel', 'title', 'savename')
+
+    x: VariableSpec     # Variable on the x-axis.
+    ys: list            # VariableSpec of each variable on the y-axis.
+    xlabel: str
+    ylabel: str
+    title: str
+    savename: str       # Filename of the saved figure.
+
+
+def generate_report(log, savepath, reportname="report.md", *,
+                    max_workers=1,
+                    ):
     """
     Convert a log file to a markdown-style report with links to plots.
 
@@ -69,77 +102,241 @@ def generate_report(log, savepath, reportname="report.md"):
     reportname : str, optional
         Name of the report file. The default is "report.md".
 
+    Keyword Arguments
+    -----------------
+    max_workers : int or None, optional
+        Maximum number of processes used to render plots. None uses
+        one process per CPU. The default is 1, which renders in the
+        calling process. Rendering in more than one process starts
+        new interpreters that import the calling script, so on
+        Windows and macOS the call must be under an
+        ``if __name__ == '__main__':`` guard.
+
     Returns
     -------
     None.
 
+    Raises
+    ------
+    ValueError
+        If max_workers is less than 1.
+
     """
+    # Check the number of workers before any work is done. Only None
+    # means one per CPU.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    elif max_workers < 1:
+        raise ValueError(
+            f"generate_report: max_workers must be at least 1 or None, "
+            f"not {max_workers!r}")
+
     # Instantiate the log reader.
     n_logs = log.n_logs
 
     # Make sure the target folder is available.
-    if not os.path.isdir(savepath):
-        os.mkdir(savepath)
+    os.makedirs(savepath, exist_ok=True)
 
     # Container for information (variables, names) of each plot.
     plot_info = []
-    # Container for data from every log.
-    data = []
-    # Open the report markdown file, ensuring that it'll be closed when
-    # all is said and done. Truncate (overwrite) the report file.
+    # Container for the rewritten notes, written to the report at once.
+    chunks = []
+    # Rewrite the log's header information and make note of the
+    # requested plots.
+    text, info = add_to_report(log.header, tuple(range(n_logs)))
+    chunks.append(text)
+    plot_info.extend(info)
+
+    # Add test-specific notes and save off information about the
+    # requested plots. Data is only gathered once it is known which
+    # variables the plots actually use.
+    for test_idx in range(log.n_logs):
+        dat = log.get_log(test_idx)
+        text, info = add_to_report(dat['Notes'], (test_idx,))
+        chunks.append(text)
+        plot_info.extend(info)
+
+    # Write the report markdown file in one go. Truncate (overwrite)
+    # the report file. Each chunk ends with a newline, as print() did.
     with open(os.path.join(savepath, reportname),
               'w',
               encoding='utf-8',
               ) as report_file:
-        # Print the log's header information and make note of the
-        # requested plots.
-        plot_info.extend(add_to_report(log.header,
-                                       report_file,
-                                       tuple(range(n_logs)),
-                                       ))
-
-        # Add test-specific notes and save off information about the
-        # requested plots. Store each dataset as an item in the list.
-        for test_idx in range(log.n_logs):
-            dat = log.get_log(test_idx)
-            data.append(dat['Data'])
-
-            plot_info.extend(add_to_report(dat['Notes'],
-                                           report_file,
-                                           (test_idx,),
-                                           ))
-
-    # Generate plots. This is a very nested sequence.
+        report_file.write("\n".join(chunks) + "\n")
+
+    # Arrays converted so far, shared between batches of plots.
+    arrays = {}
+    # Generate plots. Each plot is independent, so if more than one
+    # worker is allowed, they are split into one batch per worker
+    # process and rendered in parallel.
+    n_batches = min(len(plot_info), max_workers)
+    if n_batches <= 1:
+        _render_plots(plot_info,
+                      _collect_data(log, plot_info, arrays),
+                      savepath)
+        return
+    batches = [plot_info[i::n_batches] for i in range(n_batches)]
+    # Only send each worker the data that its plots use.
+    batch_data = [_collect_data(log, batch, arrays) for batch in batches]
+    with ProcessPoolExecutor(max_workers=n_batches) as executor:
+        # Consume the results so that worker exceptions are raised.
+        list(executor.map(_render_plots,
+                          batches,
+                          batch_data,
+                          repeat(savepath),
+                          ))
+
+
+def _collect_data(log, plot_info, arrays):
+    """
+    Gather the data used by the plots in plot_info.
+
+    Only variables that are plotted are converted to arrays, so that
+    they can be scaled without a Python-level loop. Conversions are
+    kept in arrays, keyed by (test_idx, key), so data shared between
+    plots is only converted once.
+
+    Parameters
+    ----------
+    log : log_parser.Log
+        Object managing a log file.
+    plot_info : list
+        List of PlotSpec, one for each plot.
+    arrays : dict
+        Arrays converted so far. Updated in place.
+
+    Returns
+    -------
+    dict
+        Data dictionary of each test used, indexed by test index.
+
+    """
+    data = {}
+    for info in plot_info:
+        x_key = info.x.name
+        for y in info.ys:
+            for test_idx in y.tests:
+                test_data = data.setdefault(test_idx, {})
+                for key in (x_key, y.name):
+                    k = (test_idx, key)
+                    if k not in arrays:
+                        arrays[k] = np.asarray(
+                            log.get_log(test_idx)['Data'][key],
+                            dtype=np.float64)
+                    test_data[key] = arrays[k]
+    return data
+
+
+def _render_plots(plot_info, data, savepath):
+    """
+    Generate and save the plots requested in plot_info.
+
+    Parameters
+    ----------
+    plot_info : list
+        List of PlotSpec, one for each plot.
+    data : dict
+        Data dictionary of each test, indexed by test index.
+    savepath : str
+        Folder to save figures in.
+
+    Returns
+    -------
+    None.
+
+    """
+    # This is a very nested sequence.
     # - For each requested figure, find the x variable's key and scale.
     # - For each y variable, find the y variable's key and scale factor.
     # - For each requested curve of said y variable (test_idx), plot the
     #   x and y data.
+    #
+    # A single figure is built once and cleared for each plot. It is
+    # created without pyplot, so no GUI backend or window is involved
+    # and nothing is left open in pyplot's figure manager.
+    fig = Figure()
+    ax = fig.subplots()
+
+    # Scaled data for the current figure, keyed by (test_idx, key,
+    # scale), so that data shared between curves (usually the x
+    # variable) is only scaled once.
+    scaled = {}
+
+    def get_scaled(test_idx, key, scale):
+        """Return scaled data, scaling it only on first request."""
+        k = (test_idx, key, scale)
+        values = scaled.get(k)
+        if values is None:
+            values = scaled[k] = _scale(data[test_idx][key], scale)
+        return values
+
     for info in plot_info:
-        fig, ax = plt.subplots()
-        x_key = info['variables']['x']['name']
-        x_scale = info['variables']['x']['scale']
-
-        for y in info['variables']['y']:
-            y_key = y['name']
-            y_scale = y['scale']
-            for test_idx in y['tests']:
-                x_data = [x * x_scale for x in data[test_idx][x_key]]
-                y_data = [y * y_scale for y in data[test_idx][y_key]]
-                ax.plot(x_data, y_data,
-                        marker='*',
-                        markersize=2,
-                        label=f"{y_key} : Test {test_idx}",
-                        )
-        ax.set_xlabel(info['labels']['xlabel'])
-        ax.set_ylabel(info['labels']['ylabel'])
-        ax.set_title(info['labels']['title'])
+        ax.clear()
+        scaled.clear()
+        x_key = info.x.name
+        x_scale = info.x.scale
+
+        for y in info.ys:
+            y_key = y.name
+            y_scale = y.scale
+            tests = y.tests
+            x_data = [get_scaled(test_idx, x_key, x_scale)
+                      for test_idx in tests]
+            y_data = [get_scaled(test_idx, y_key, y_scale)
+                      for test_idx in tests]
+            # If every curve is the same length, stack them as columns
+            # and draw them all with one call to ax.plot().
+            if len(tests) > 1 and len({len(d) for d in x_data + y_data}) == 1:
+                x_data = [np.column_stack(x_data)]
+                y_data = [np.column_stack(y_data)]
+            lines = []
+            for x_curves, y_curves in zip(x_data, y_data):
+                lines.extend(ax.plot(x_curves, y_curves,
+                                     marker='*',
+                                     markersize=2,
+                                     ))
+            # Lines come back in the order of the tests.
+            for line, test_idx in zip(lines, tests):
+                line.set_label(f"{y_key} : Test {test_idx}")
+        ax.set_xlabel(info.xlabel)
+        ax.set_ylabel(info.ylabel)
+        ax.set_title(info.title)
         ax.legend()
-        fig.savefig(os.path.join(savepath, info['savename']))
+        # PNG encoding dominates the cost of saving small plots. A low
+        # zlib level is much faster for slightly larger files.
+        fig.savefig(os.path.join(savepath, info.savename),
+                    pil_kwargs={'compress_level': 1},
+                    )
+
+
+def _scale(values, scale):
+    """
+    Return values multiplied by scale.
+
+    Scaling is a single vectorized NumPy multiply. Most callouts don't
+    request a scaling factor, so the copy is skipped for a scale of 1.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Data to be scaled.
+    scale : float
+        Scaling factor.
 
+    Returns
+    -------
+    numpy.ndarray
+        Scaled data. This is values itself if scale is 1.
 
-def add_to_report(text, file, default_tests):
     """
-    Add notes to file, replacing plot callouts with markdown links.
+    if scale == 1:
+        return values
+    return values * scale
+
+
+def add_to_report(text, default_tests):
+    """
+    Rewrite notes for the report, replacing plot callouts with links.
 
     Also collects requested plot contents for later generation.
 
@@ -152,48 +349,68 @@ def add_to_report(text, file, default_tests):
     ----------
     text : string
         Notes to be added.
-    file : io.TextIOWrapper
-        Opened, writeable file to send the text to.
     test_idx : tuple
         List of log indices to use if none were provided by the user.
 
     Returns
     -------
+    text : string
+        Notes with every plot callout replaced by a markdown link.
     plot_info : list
-        List of data dictionaries containing labels, variables, and
-        savename information for each plot.
+        List of PlotSpec, one for each plot.
 
     """
-    # Find a plot callout.
-    callout = pattern_callout.search(text)
     plot_info = []
-    while callout:
-        # Get request from the callout.
-        labels = extract_labels(callout)
-        variables = extract_vars(callout)
-
-        # Fill in missing test index callouts using test_idx.
-        for y in variables['y']:
-            if not y['tests']:
-                y['tests'] = default_tests
-
+    # Walk the text once, collecting the text between callouts and the
+    # links that replace them, then join everything at the end.
+    out = []
+    pos = 0
+    for callout in pattern_callout.finditer(text):
+        out.append(text[pos:callout.start()])
         # Store request so plots can be generated later.
-        plot_info.append({'labels': labels,
-                          'variables': variables,
-                          })
-        savename = f"{labels['title']}.png"
-        # Keep the savename for when the plot is generated.
-        plot_info[-1].update({'savename': savename})
+        info = _parse_callout(callout, default_tests)
+        plot_info.append(info)
         # Markdown gets confused by spaces, so use percent-encoding.
-        savename = savename.replace(' ', '%20')
+        savename = info.savename.replace(' ', '%20')
         # Replace callout with markdown link.
-        text = pattern_callout.sub(f"![]({savename})", text, count=1)
+        out.append(f"![]({savename})")
+        pos = callout.end()
+    out.append(text[pos:])
+    return "".join(out), plot_info
 
-        # Find the next callout.
-        callout = pattern_callout.search(text)
-    # Write reformatted text to the file.
-    print(text, file=file)
-    return plot_info
+
+def _parse_callout(callout, default_tests):
+    """
+    Collect everything needed to generate the plot a callout requests.
+
+    Parameters
+    ----------
+    callout : re.Match
+        Match from pattern_callout.search(), containing 'vars' and
+        'labels' groups.
+    default_tests : tuple
+        List of log indices to use if none were provided by the user.
+
+    Returns
+    -------
+    PlotSpec
+        Labels, variables, and savename information for the plot.
+
+    """
+    labels = extract_labels(callout)
+    x, ys = extract_vars(callout)
+
+    # Fill in missing test index callouts using default_tests.
+    for y in ys:
+        if not y.tests:
+            y.tests = default_tests
+
+    return PlotSpec(x=x,
+                    ys=ys,
+                    # Keep the savename for when the plot is generated.
+                    savename=f"{labels['title']}.png",
+                    **labels,
+                    )
 
 
 def extract_labels(callout):
@@ -212,18 +429,20 @@ def extract_labels(callout):
         Dictionary of plot labels: xlabel, ylabel, title.
 
     """
-    # The labels must be comma delimited. Remove whitespace and
-    # store in a list.
-    labels = [s.strip() for s in callout['labels'].split(',')]
+    # The labels must be comma delimited. Split at most twice so that
+    # any further commas stay in the title.
+    xlabel, ylabel, title = callout['labels'].split(',', 2)
     # Labels must be in a fixed order. Convert to a dictionary for
-    # code readability.
-    label_names = ['xlabel', 'ylabel', 'title']
-    return dict(zip(label_names, labels))
+    # code readability, removing whitespace.
+    return {'xlabel': xlabel.strip(),
+            'ylabel': ylabel.strip(),
+            'title': title.strip(),
+            }
 
 
 def extract_vars(callout):
     """
-    Return variable keys and test indices in a data dictionary.
+    Return variable keys, test indices, and scaling factors.
 
     Parameters
     ----------
@@ -233,77 +452,94 @@ def extract_vars(callout):
 
     Returns
     -------
-    dict
-        Dictionary of data callouts:
-            x : str
-                Key of the x variable.
-            y : list
-                list of dictionaries of y variable information:
-                    name : str
-                        Key of the y variable.
-                    tests : tuple
-                        Tuple of test indices.
+    x : VariableSpec
+        The x variable.
+    ys : list
+        VariableSpec of each y variable.
+
+    Raises
+    ------
+    ValueError
+        If the callout doesn't name any variables.
 
     """
-    # Identify variable groups and read into a list. Each variable
-    # callout has three components - name, test numbers to plot from,
-    # and a scaling factor. These are stored in a dictionary for each
-    # match of pattern_variables.
-    variables = pattern_variables.finditer(callout['vars'])
-    variables = [v.groupdict() for v in variables]
-
-    # Clean up/interpret variable information.
-    for v in variables:
-        # Clean up variable names.
-        v['name'] = v['name'].strip()
-
-        # Convert test numbers from a string to a tuple.
-        # re.findall() can't handle a None, so replace with an
-        # empty string. This results in y['tests']=()
-        if not v['tests']:
-            v['tests'] = ''
-        # Identify numbers and store in a tuple.
-        v_tests = tuple(int(n) for n in re.findall(r'\d+', v['tests']))
-        v.update({'tests': v_tests})
-
-        # Identify scaling factors.
-        if v['scale']:
-            # Scaling factor is a single number inside square brackets.
-            v['scale'] = float(v['scale'].strip('[]'))
-        else:
-            v['scale'] = 1
+    # Identify variable groups. Each variable callout has three
+    # components - name, test numbers to plot from, and a scaling
+    # factor. These are cleaned up one match of pattern_variables at a
+    # time, without building an intermediate list of raw matches.
+    variables = (_clean_var(v)
+                 for v in pattern_variables.finditer(callout['vars']))
 
     # The first value is the x variable. The rest are y variables.
-    return {'x': variables.pop(0), 'y': variables}
+    try:
+        x = next(variables)
+    except StopIteration:
+        raise ValueError(
+            f"No variables found in plot callout {callout.group()!r}"
+            ) from None
+    return x, list(variables)
+
+
+def _clean_var(match):
+    """Interpret the name, tests, and scale of a variable callout."""
+    # Convert test numbers from a string to a tuple.
+    # re.findall() can't handle a None, so replace with an
+    # empty string. This results in y.tests=()
+    tests = match.group('tests') or ''
+    # Scaling factor is a single number inside square brackets.
+    scale = match.group('scale')
+    return VariableSpec(
+        name=match.group('name'),
+        tests=tuple(int(n) for n in pattern_digits.findall(tests)),
+        scale=float(scale.strip('[]')) if scale else 1,
+        )
 
 
 # Detect plot callout.
 pattern_callout = re.compile(
     r'''
     \\p                 # \p is the 'plot' callout character
-    \{(?P<vars>.+)\}    #   variable information is stored between {}
-                        #     (group 1 = vars)
+    \{                  #   variable information is stored between {}
+    (?P<vars>[^{}\n]+)  #     (group 1 = vars). Negated classes keep
+    \}                  #     the match to one callout, no backtracking.
     \n?\s*              # Optional single newline/whitespace.
-    \((?P<labels>.+)\)  # label information is stored between ()
-                        #     (group 2 = labels)
-    ''', re.VERBOSE)
+    \(                  # label information is stored between ()
+    (?P<labels>         #     (group 2 = labels). Labels may hold one
+     (?:[^()\n]         #     level of parentheses, e.g. units, and
+      |\([^()\n]*\)     #     each character still has only one way
+     )+                 #     to match.
+    )
+    \)
+    ''', re.VERBOSE | re.ASCII)
 
 # Identify variable names and test identifiers (if present).
-# Variable callout format: name(test_no, test_no, ...).
+# Variable callout format: name(test_no, test_no, ...)[scale].
 # Commas are required between test numbers. Whitespace is optional.
+# Variable names are matched with Unicode \w, as Log reads column
+# names, so that any column can be called out.
+#
+# Every piece is written so that there is only one way to match it:
+# names are words separated by whitespace (never ending in whitespace),
+# and whitespace between pieces is consumed by its own \s*. A failed
+# match therefore gives up without retrying other ways to split the
+# text between the name, tests, and scale.
 pattern_variables = re.compile(
     r'''
+    \s*                 # Whitespace between variables.
     (?:                 # Start of group
-     (?P<name>[\w\s]+)  # Variable name (group 1 = name)
+     (?P<name>          # Variable name (group 1 = name)
+      \w+               # First word.
+      (?:\s+\w+)*       # Further words, each after whitespace.
+     )
+     \s*
 
      (?P<tests>         # Test number callout (group 2 = tests)
       \(                # Opening parenthesis
-      (?:               # Uncaptured group - possible repeating #, ...
-       \s*\d+\s*,       # Leading test numbers (#,) possible whitespace
-      )*                # May be several, or none.
-      \s*\d+\s*         # final number, no trailing comma.
-      \)                # Closing paerenthesis
+      \s*\d+            # First test number, possible whitespace.
+      (?:\s*,\s*\d+)*   # Any further numbers, each after a comma.
+      \s*\)             # Closing parenthesis
      )?                 # May or may not include (#, ...)
+     \s*
 
      (?P<scale>         # Scaling factor (group 3 = scale)
       \[                # Opening square bracket
@@ -311,7 +547,11 @@ pattern_variables = re.compile(
                         #     exponent.
       \]                # Closing square bracket
      )?                 # May or may not include [#]
+     \s*
 
     ),?                 # End of group, may or may not be trailed by
                         # comma.
     ''', re.VERBOSE)
+
+# Identify test numbers within a variable's test callout.
+pattern_digits = re.compile(r'\d+', re.ASCII)
@@ -35,32 +35,54 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Ben Hubbard / v1.0.0
 """
 
+import array
+import contextlib
+import functools
+import io
+import math
+import mmap
+import os
 import re
 
 
 # Text interpreter settings
 # TODO: allow user to provide their own regex format. Make these
 #       built-ins.
+#
+# Patterns are bytes, as the file is scanned without decoding it, and
+# are searched across the whole file at once. Every pattern is anchored
+# to the start of a line, so each match starts exactly where its log
+# does, and at most one match is found per line. '^' with MULTILINE
+# would only follow '\n', but the file is read in text mode, where a
+# lone '\r' also ends a line, so the anchor is written out by hand:
+# no character before the match other than '\r' or '\n'. This also
+# matches at the start of the file.
 log_start_formats = {
     'lvm': re.compile(      # NI Signal Express
-        r"""
-        ^            # Start of the line
-        (Test_Name)  # .lvm log start.
+        rb"""
+        (?<![^\r\n])        # Start of the line
+        (Test_Name)         # .lvm log start.
         """, re.VERBOSE),
     'lvmspl': re.compile(  # NI Signal Express Sound pressure data.
-        r"""
-        ^           # Start of the line
+        rb"""
+        (?<![^\r\n])        # Start of the line
         (Packet_Notes)
         """, re.VERBOSE),
     'putty': re.compile(    # PuTTY log
-        r'''
-        ^           # Start of the line
-        ([^=~]*)    # Anything not = or ~ (for header on line w/ data)
-        (=~)        # Putty log start.
+        rb'''
+        (?<![^\r\n])        # Start of the line
+        ([^=~\r\n]*)        # Anything not = or ~ (for header on line
+                            #   w/ data) on the same line.
+        (=~)                # Putty log start.
         ''', re.VERBOSE),
     'nivb': re.compile(     # NI Virtual Bench
-        r"""            # There is no appending here, but the first
-        (NI\sVB-\d*)    # line identifies the bench in use.
+        rb"""               # There is no appending here, but the
+                            # first line identifies the bench in use.
+        (?<![^\r\n])        # Start of the line
+        [^\r\n]*?           # Anything before the bench on the same
+                            #   line.
+        (NI[^\S\r\n]VB-\d*) # Only horizontal whitespace, so the
+                            #   match stays on one line.
         """, re.VERBOSE),
         }
 date_format = re.compile(
@@ -81,6 +103,46 @@ time_format = re.compile(
         """, re.VERBOSE)
 
 
+# Data and column header recognition. These depend on the delimiter,
+# so they are built once per delimiter and reused.
+@functools.lru_cache(maxsize=8)
+def _numeric_chars(delim):
+    """Return the set of characters that a line of data may contain."""
+    return frozenset('0123456789.+-Ee \t\r\n' + delim)
+
+
+@functools.lru_cache(maxsize=8)
+def _name_format(delim):
+    """Generate the regex for finding data column headers."""
+    return re.compile(
+        rf"""
+        (?<![\w\s])             # Start at the start of a run of words.
+                                #   A later start in the same run ends
+                                #   at the same place, so retrying there
+                                #   would only be quadratic backtracking.
+        ([\w\s]+)               # Any word (alphanumeric), which takes
+                                #   any space before the label's end.
+        [{re.escape(delim)}[(\r\n]  # Labels could run against '('
+                                #   '[', '\r', '\n', or delim
+        """, re.VERBOSE)
+
+
+# Comma is the default delimiter. Build its patterns at import, so the
+# default path through Log.read_data_in_range() never compiles them.
+_name_format(',')
+_numeric_chars(',')
+
+# Starting contents of each log's dictionary. Log.__init_dat() copies
+# this once per log and fills in the parts that differ.
+_dat_template = {
+    'Date': "",         # Stores the test date
+    'Start Time': "",   # Stores the start time
+    'Idx': None,        # (start, stop)
+    'Notes': "",        # Holds any header information
+    'Data': None,       # Carries the data for each test
+    }
+
+
 class Log:
     """
     Interfaces with a single log file.
@@ -110,8 +172,9 @@ class Log:
         Keyword Arugments
         -----------------
         encoding : str, optional
-            File encoding for reading and writing. The default is
-            "utf8".
+            File encoding for reading and writing. Must be
+            ASCII-compatible (e.g. "utf8" or "latin-1"), as log starts
+            are found in the undecoded file. The default is "utf8".
         is_save_non_data_output : bool, optional
             Indicate whether non-numerical outut in the log (i.e. below
             the column headers) should be saved as Notes. The default
@@ -140,97 +203,47 @@ class Log:
         self.__log_start_format = log_start_formats[log_type]
 
         self.path = filepath
-        # Immediately search out all of the log starts.
-        self.__log_idxs = self.__find_log_starts()
-        self.n_logs = len(self.__log_idxs)
+        # Immediately search out all of the log starts, and read the
+        # header in the same pass over the file.
+        self.__log_offsets, self.header = self.__find_log_starts()
+        self.n_logs = len(self.__log_offsets) - 1
         # Check for no logs
         # assert self.n_logs, "No logs found. Check your log_type."
         # Allocate a dictionary for each log's data.
         self.__init_dat()
-        self.__read_header()
-
-    # Data recognition. Edge cases handled by a gatekeeper below.
-    def __make_name_format(delim):
-        """Generate the regex for finding data column headers."""
-        return re.compile(
-            rf"""
-            ([\w\s]+)               # Any word (alphanumeric)
-            \s*                     # There might be a space...
-            [{{{delim}}}\[\(\r\n]   # Labels could run against '('
-                                    #   '[', '\r', '\n', or delim
-            """, re.VERBOSE)
-
-    def __make_data_format(delim):
-        """Generate the regex for finding data in columns."""
-        return re.compile(
-            rf"""
-            ([-\d.\+Ee]*)       # Any (or no) number (with decimal,
-                                # negative, exp)
-            [{{{delim}}}\r\n]   # Numbers could run against the
-                                #   delimiter or a new line.
-            """, re.VERBOSE)
-
-    def __re_get(regex, line):
-        """
-        Search line using regex and return the first group.
-
-        Returns '' if no result is found.
-        Returns the entire match if no groups.
-        """
-        result = regex.search(line)
-        if result:
-            if result.groups():
-                return result.groups()[0]
-            # If there are no groups...
-            return result.group()
-        # if there is no result
-        return ''
 
     def __find_log_starts(self):
         """
-        Open the file and locate all PuTTY Headers.
+        Open the file, locate all log starts, and read the header.
 
-        Returns a tuple of (start, stop) tuples.
+        Returns a tuple of (offsets, header). offsets is an array.array
+        of byte offsets: the start of each log, followed by the end of
+        the file. Log i runs from offset i to offset i + 1, so each
+        boundary is stored once as a packed 64-bit integer. header is
+        any text prior to the first log start.
         """
-        # Open the file with read-only access.
-        with open(self.path, 'r', encoding=self.__encoding) as file:
-
-            # Record the stream location.
-            f_loc = file.tell()
-            # Read the line. This changes the stream location.
-            line = file.readline()
-            # Storage objects for starts and stops.
-            start_idxs = []
-            stop_idxs = []
-            while line:
-                # Read the line and check for a log start.
-                #
-
-                parse = self.__log_start_format.search(line)
-
-                if parse:
-                    # We found a header.
-                    # Save the end-point of the last (if there is one).
-                    if start_idxs:
-                        stop_idxs.append(f_loc)
-                    # Save the start-point (file.tell() from before the
-                    # line was read).
-                    start_idxs.append(f_loc)
-                    # Determine if there's data on the same line as
-                    # the header.
-                    parse = parse.groups()
-                    if parse[0]:
-                        # TODO: this detects data on the same line as the
-                        # header, but cannot do anything about it.
-                        pass
-
-                # Record the stream location.
-                f_loc = file.tell()
-                # Read the line. This changes the stream location.
-                line = file.readline()
-            # Append the final end-point.
-            stop_idxs.append(file.tell())
-        return tuple(zip(start_idxs, stop_idxs))
+        # Open the file with read-only access and map it into memory.
+        # The whole mapping is searched in one pass of the regex engine,
+        # with no decoding, and match positions are byte offsets.
+        #
+        # TODO: the putty format detects data on the same line as the
+        # header (group 1), but cannot do anything about it.
+        with open(self.path, 'rb') as file:
+            # An empty file can't be mapped. It holds no logs and no
+            # header.
+            if not os.fstat(file.fileno()).st_size:
+                return array.array('q', [0]), ''
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offsets = array.array('q', (
+                    parse.start()
+                    for parse in self.__log_start_format.finditer(mm)))
+                # Each log stops where the next starts, and the last
+                # stops at the end of the file.
+                offsets.append(len(mm))
+                # Read the header while the file is still mapped. There
+                # may not be a header, in which case this is empty.
+                header = ''.join(self.__iter_lines(mm, 0, offsets[0]))
+        return offsets, header
 
     def __init_dat(self):
         """
@@ -244,39 +257,60 @@ class Log:
             Data -- Any numerical data provided, with named and unnamed
                     data stored separately.
         """
-        self.__dat = [{
-                'Date': "",         # Stores the test date
-                'Start Time': "",   # Stores the start time
-                'Idx': self.__log_idxs[i],    # (start, stop)
-                'Notes': "",        # Holds any header information
-                'Data': {},         # Carries the data for each test
-                } for i in range(self.n_logs)]
-
-    def __read_header(self):
+        # A shallow copy shares only the immutable values, so each log
+        # gets its own Idx and a fresh Data dictionary.
+        offsets = self.__log_offsets
+        self.__dat = []
+        for start, stop in zip(offsets, offsets[1:]):
+            dat = _dat_template.copy()
+            dat['Idx'] = (start, stop)
+            dat['Data'] = {}
+            self.__dat.append(dat)
+
+    @contextlib.contextmanager
+    def __read_lines(self, start, stop):
         """
-        Read and save information from the header.
+        Read the text from start (inclusive) to stop (exclusive).
+
+        The file is memory mapped for as long as the context is open.
 
-        The header is any text prior to the first log start.
+        Yields an iterator over the lines of the range.
         """
-        # Allocate a dictionary to add information to.
-        dat = ""
-        stop = self.__log_idxs[0][0]
-        with open(self.path, 'r', encoding=self.__encoding) as file:
-            # There may not be a header.
-            if file.tell() == stop:
-                self.header = ""
+        with open(self.path, 'rb') as file:
+            # An empty file can't be mapped, and has no lines to read.
+            if not os.fstat(file.fileno()).st_size:
+                yield iter(())
                 return
-            # Read in the header
-            line = file.readline()
-            while line:
-                # Stop if the first log has been reached.
-                if file.tell() == stop:
-                    break
-                # Copy the line into the header info.
-                dat += line
-                # Read the next line.
-                line = file.readline()
-        self.header = dat
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield self.__iter_lines(mm, start, stop)
+
+    def __iter_lines(self, mm, start, stop):
+        """
+        Decode the lines of a memory mapped range, one at a time.
+
+        Only one line is held in memory at once. Newlines are
+        translated to '\\n', as when reading the file in text mode. A
+        negative stop reads to the end of the file.
+        """
+        size = len(mm)
+        stop = size if stop < 0 else min(stop, size)
+        if start >= stop:
+            return
+        mm.seek(start)
+        pos = start
+        while pos < stop:
+            raw = mm.readline()
+            pos += len(raw)
+            if pos > stop:
+                # The range ends partway through this line.
+                raw = raw[:stop - pos]
+            line = raw.decode(self.__encoding)
+            if '\r' in line:
+                # A lone '\r' also ends a line in text mode, and may
+                # split this one.
+                yield from io.StringIO(line, newline=None)
+            else:
+                yield line
 
     def get_log(self, log=0, *, delim=','):
         """
@@ -347,8 +381,9 @@ class Log:
 
         Keyword Arguments
         -----------------
-            start -- filestream start-point (inclusive)
-            stop -- filestream end-point (exclusive)
+            start -- byte offset of the start-point (inclusive)
+            stop -- byte offset of the end-point (exclusive). A
+                    negative value reads to the end of the file.
             delim -- data delimiter.
 
         Returns
@@ -356,21 +391,23 @@ class Log:
             dat -- a dictionary of all read data with the fields:
                 Notes -- any lines determined to be not data
                 Data -- any lines determined to be data, named and cast
-                    to floats.
+                    to floats. Each named dataset is an
+                    array.array('d'). Unnamed data is under '', as a
+                    list of each row's extra values.
         """
-        data_format = Log.__make_data_format(delim)
-        name_format = Log.__make_name_format(delim)
-        with open(self.path, 'r', encoding=self.__encoding) as file:
-            # Go to the starting point.
-            file.seek(start)
-            # Read the first line.
-            line = file.readline()
+        name_format = _name_format(delim)
+        numeric_chars = _numeric_chars(delim)
+        # Work through the range one line at a time.
+        with self.__read_lines(start, stop) as lines:
             last_line = ''
-            is_stop = False
             # Boolean to determine if non-data should be saved to Notes.
             # This becomes False after 'names' are read iff
             # self.__save_non_data_output=False
             is_save_more_notes = True
+            # Booleans to stop looking for the date and time once each
+            # has been found.
+            need_date = True
+            need_time = True
             # The list of column names will be filled in the loop.
             names = []
             # Initialize the data structure. Notes is the only known
@@ -381,54 +418,57 @@ class Log:
                 'Notes': '',
                 'Data': {}
                 }
-            while line:
-                # While the line is non-empty
-                if is_stop:
-                    break
-                if file.tell() == stop:
-                    # Quit if at cutoff. file.tell() returns an
-                    # 'opaque' number not necessarily related to
-                    # n_bytes since the start of the file...
-                    # https://docs.python.org/3/library/
-                    # io.html#io.TextIOBase.tell
-                    #
-                    # This is a delayed action, the break happens at
-                    # next iteration.
-                    is_stop = True
-
+            for line in lines:
                 # Gatekeeper:
                 #
                 # If the line contains data, it must be more than just
-                # white space. If it contains something besides data,
-                # it will be non-empty after stripping out all
-                # whitespace, data-like substrings, and delimiters.
-                line_minus_data = (
-                    data_format.sub('', line)
-                    .replace(delim, '')
-                    .strip()
-                    )
-                if line_minus_data or not line.strip():
-                    # Line is just whitespace, or the sub'd line
-                    # was non-empty,meaning this is not data.
+                # white space, and every delimited field must be a
+                # number. Lines with any character that can't be part
+                # of a number or delimiter are turned away first, by a
+                # C-level scan that stops at the first such character.
+                # float() then both checks and converts each field.
+                # isspace() checks for a blank line without building a
+                # stripped copy of it.
+                is_data = (not line.isspace()
+                           and numeric_chars.issuperset(line))
+                if is_data:
+                    parts = line.split(delim)
+                    try:
+                        # Convert the whole row in a single map(), which
+                        # calls float() from C. float() ignores the
+                        # whitespace around each field.
+                        data = list(map(float, parts))
+                    except ValueError:
+                        # Empty fields (i.e. from a csv) are NaN. Any
+                        # other field that isn't a number means this is
+                        # not data.
+                        try:
+                            data = list(map(float, (p.strip() or 'nan'
+                                                    for p in parts)))
+                        except ValueError:
+                            is_data = False
+                if not is_data:
+                    # Line is just whitespace, or a field was not a
+                    # number, meaning this is not data.
                     if is_save_more_notes:
                         dat['Notes'] += line
-                        # Parse the header for date and time.
-                        if not dat['Date']:
-                            dat['Date'] = Log.__re_get(date_format, line)
-                        if not dat['Start Time']:
-                            dat['Start Time'] = Log.__re_get(time_format, line)
+                        # Parse the header for date and time. A date
+                        # needs a '/' or '.' separator and a time needs
+                        # ':', so skip the regex for lines without one.
+                        if need_date and ('/' in line or '.' in line):
+                            found = date_format.search(line)
+                            if found:
+                                dat['Date'] = found.group()
+                                need_date = False
+                        if need_time and ':' in line:
+                            found = time_format.search(line)
+                            if found:
+                                dat['Start Time'] = found.group()
+                                need_time = False
                     last_line = line
-                    line = file.readline()
                     continue
                 # The line contains data, and data only.
 
-                # Read each column of data.
-                data = data_format.findall(line)
-
-                # Replace any empty values (whitespace or '') (i.e.
-                # from a csv) with NaN.
-                data = [d if d.strip() else 'nan' for d in data]
-
                 # The first time that the loop makes it to here, names
                 # will be empty. Assume that the names are given in the
                 # previous line. Prep this after parsing the data into
@@ -438,28 +478,41 @@ class Log:
                                   name_format.findall(last_line))
                     # Store the number of named pieces of data.
                     n_names = len(names)
-                    # Add storage for any excess data.
+                    # Create a packed array of doubles for each named
+                    # dataset. These hold 8 bytes per value, rather
+                    # than a list of references to float objects.
+                    dat['Data'].update(
+                        {name: array.array('d') for name in names})
+                    # Add storage for any excess data. Rows may have
+                    # different amounts, so this is a list of lists.
                     names += ('',)
-                    # Create a dictionary of lists (for each dataset).
-                    dat['Data'].update({name: [] for name in names})
+                    dat['Data'][''] = []
+                    # Keep each dataset alongside the index of its
+                    # value in a row, so rows can be added without
+                    # looking them up by name. A repeated name keeps
+                    # only its last value in each row (this includes a
+                    # name that strips to '', which the excess data
+                    # replaces).
+                    last_idx = {name: i for i, name in enumerate(names)}
+                    columns = tuple((i, dat['Data'][name])
+                                    for name, i in last_idx.items())
                     if not self.__is_save_non_data_output:
                         is_save_more_notes = False
 
+                # Pad short rows with NaN, so every named dataset
+                # stays the same length.
+                if len(data) < n_names:
+                    data += [math.nan] * (n_names - len(data))
                 # Group all unnamed data into a single list within a
                 # tuple while separating named data. The gatekeeper has
-                # ensured all information is numeric.
-                data = tuple([float(d) for d in data[0:n_names]]
-                             + [[float(d) for d in data[n_names:]]])
-                # Match the named data with its name. Unnamed data will
-                # go into ' ', and names w/o data will just see [].
-                named_data = dict(zip(names, data))
-                # Add all data to dat
-                for name in named_data.keys():
-                    # Cast the string into a float.
-                    dat['Data'][name].append(named_data[name])
-
-                # Finish by reading the next line. This ensures the
-                # loop will stop at End-Of-File (EOF).
+                # already converted all information to floats.
+                data = tuple(data[0:n_names] + [data[n_names:]])
+                # Match the named data with its dataset and add it to
+                # dat. Unnamed data will go into ''.
+                for i, column in columns:
+                    column.append(data[i])
+
+                # Finish by remembering this line, in case the next
+                # one needs it.
                 last_line = line
-                line = file.readline()
         return dat
@@ -0,0 +1,76 @@
+"""
+Tests for the plot callout patterns in generate_report.
+
+Run from this folder with `python -m unittest test_generate_report`.
+"""
+
+import re
+import unittest
+
+from generate_report import (
+    VariableSpec,
+    extract_labels,
+    extract_vars,
+    pattern_callout,
+    )
+
+
+def parse(text):
+    """Return (x, ys, labels) for the first callout in text."""
+    callout = pattern_callout.search(text)
+    x, ys = extract_vars(callout)
+    return x, ys, extract_labels(callout)
+
+
+class TestCallouts(unittest.TestCase):
+    """Callouts from the module docstring and common variants."""
+
+    def test_docstring_example(self):
+        x, ys, labels = parse(
+            "\\p{time, temp(0, 2), mass(1, 2)}\n"
+            "    (time [s], temperature [K], some title)")
+        self.assertEqual(x, VariableSpec('time', (), 1))
+        self.assertEqual(ys, [VariableSpec('temp', (0, 2), 1),
+                              VariableSpec('mass', (1, 2), 1)])
+        self.assertEqual(labels, {'xlabel': 'time [s]',
+                                  'ylabel': 'temperature [K]',
+                                  'title': 'some title'})
+
+    def test_whitespace_variants(self):
+        expected = [VariableSpec('A', (), 1),
+                    VariableSpec('B', (), 2.0),
+                    VariableSpec('C', (1, 3), -1.5)]
+        for text in ("A,B[2],C(1,3)[-1.5]",
+                     "A, B [2], C (1, 3) [ -1.5 ]",
+                     " A ,  B[ 2 ] ,C( 1 ,3 )[-1.5] ",
+                     "A,\tB [2],\tC\t(1,\t3)\t[-1.5]\t",
+                     ):
+            with self.subTest(text=text):
+                x, ys, _ = parse(f"\\p{{{text}}}(x, y, title)")
+                self.assertEqual([x] + ys, expected)
+
+    def test_multi_word_name(self):
+        x, ys, _ = parse("\\p{time, Sensor A(0)[1e-3], Sensor  B}(x, y, t)")
+        self.assertEqual(x, VariableSpec('time', (), 1))
+        self.assertEqual(ys, [VariableSpec('Sensor A', (0,), 1e-3),
+                              VariableSpec('Sensor  B', (), 1)])
+
+    def test_unicode_name(self):
+        x, ys, _ = parse("\\p{tïme, temp}(x, y, t)")
+        self.assertEqual([x.name] + [y.name for y in ys], ['tïme', 'temp'])
+
+    def test_no_variables(self):
+        for text in ("\\p{ }(x, y, z)", "\\p{--}(x, y, z)"):
+            with self.subTest(text=text):
+                with self.assertRaisesRegex(ValueError, re.escape(text)):
+                    parse(text)
+
+    def test_labels_with_units(self):
+        _, _, labels = parse("\\p{t, v}(time (s), volt (V), title)")
+        self.assertEqual(labels, {'xlabel': 'time (s)',
+                                  'ylabel': 'volt (V)',
+                                  'title': 'title'})
+
+
+if __name__ == '__main__':
+    unittest.main()